@@ -1,13 +1,273 @@
 from .time_utils import check_datarange,days_in_year
 import os
+import csv
+import types
 import numpy as np
 import xarray as xr
 import pandas as pd
-from shapely.geometry import Point
+import shapely
+import pyproj
 import geopandas as gpd
 import datetime
+import functools
+import hashlib
 from datetime import timedelta 
 
+# Numba is optional: when it is not installed the NumPy versions of the kernels below are used
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+# Pyogrio is optional: it reads shapefiles much faster than the default Fiona engine of older geopandas
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+
+
+
+### Find the model grid points that intersect each basin polygon, without building Point geometries
+## Points are flattened in the C order of a (y, x) grid; a point on a shared boundary is kept for every basin it touches
+## Returns the flattened grid positions and the row of basins_gdf each one falls in
+def _points_in_basins(x_coords, y_coords, basins_gdf):
+    x_coords = np.asarray(x_coords, dtype=np.float64)
+    y_coords = np.asarray(y_coords, dtype=np.float64)
+    flat_idx = []
+    basin_row = []
+    for row, geom in enumerate(basins_gdf.geometry.values):
+        if geom is None or geom.is_empty:
+            continue
+
+        # Only test the block of grid points within the polygon's bounding box
+        minx, miny, maxx, maxy = geom.bounds
+        ix = np.flatnonzero((x_coords >= minx) & (x_coords <= maxx))
+        iy = np.flatnonzero((y_coords >= miny) & (y_coords <= maxy))
+        candidates = (iy[:, None]*len(x_coords) + ix[None, :]).ravel()
+
+        shapely.prepare(geom)
+        inside = shapely.intersects_xy(geom, np.tile(x_coords[ix], len(iy)), np.repeat(y_coords[iy], len(ix)))
+        flat_idx.append(candidates[inside])
+        basin_row.append(np.full(np.count_nonzero(inside), row))
+
+    # (no non-empty geometries, so no point falls in any basin)
+    if not flat_idx:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(flat_idx), np.concatenate(basin_row)
+
+
+### Encode the basin labels of the grid points inside the basins as integer codes
+## Returns the flattened grid positions, their label codes and the label names (points without a label are dropped)
+def _encode_basin_labels(flat_idx, basin_row, basins_gdf, label_column):
+    labels = pd.Categorical(basins_gdf[label_column].to_numpy()[basin_row])
+    has_label = labels.codes >= 0
+    label_code = labels.codes[has_label].astype(np.intp)
+    label_names = pd.Index(labels.categories, name=label_column)
+    return flat_idx[has_label], label_code, label_names
+
+
+# Number of IMBIE time steps interpolated from the model at once
+_INTERP_TIME_BLOCK = 12
+
+# Shapefile columns holding the basin and region labels for each ice sheet (no regions for Greenland)
+_BASIN_LABEL_COLUMNS = {'GIS': ('SUBREGION1', None), 'AIS': ('Subregion', 'Regions')}
+
+
+### Map the model grid points to the basins (and regions for Antarctica) of the shapefile
+## The mapping is cached for the most recent grids and shapefiles, e.g. for ensembles of model runs on the same grid,
+## and persisted to cache_dir (if given) so later sessions can load it instead of recomputing it
+## When projection is given and differs from the shapefile's CRS, the basins are reprojected to the model grid's projection
+def _basin_indices(x_coords, y_coords, shape_filename, icesheet, cache_dir=None, projection=None):
+    if icesheet not in _BASIN_LABEL_COLUMNS:
+        raise ValueError("Invalid iceshee value. Must be 'GIS' or 'AIS'.")
+
+    # Normalise the projection so equivalent definitions share the cached mapping
+    if projection is not None:
+        projection = pyproj.CRS.from_user_input(projection).to_wkt()
+
+    x_bytes = np.asarray(x_coords, dtype=np.float64).tobytes()
+    y_bytes = np.asarray(y_coords, dtype=np.float64).tobytes()
+    # (the .dbf file holds the basin labels and the .prj file the shapefile's CRS, which the basins are reprojected from;
+    # these are the files the disk cache key hashes)
+    shape_base = os.path.splitext(shape_filename)[0]
+    shape_mtimes = tuple(os.path.getmtime(filename) if os.path.exists(filename) else None
+                         for filename in (shape_filename, shape_base + '.dbf', shape_base + '.prj'))
+    return _cached_basin_indices(os.path.abspath(shape_filename), shape_mtimes, x_bytes, y_bytes, icesheet, cache_dir, projection)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_basin_indices(shape_filename, shape_mtimes, x_bytes, y_bytes, icesheet, cache_dir, projection):
+    basin_column, region_column = _BASIN_LABEL_COLUMNS[icesheet]
+
+    cache_filename = None
+    if cache_dir is not None:
+        # Key the cache file on the grid and its projection, the shapefile geometries, attributes and CRS, and the ice sheet
+        # (v2 files also store the dtype of the basin labels)
+        key = hashlib.sha1(x_bytes + y_bytes + icesheet.encode())
+        if projection is not None:
+            key.update(projection.encode())
+        shape_base = os.path.splitext(shape_filename)[0]
+        for filename in (shape_filename, shape_base + '.dbf', shape_base + '.prj'):
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    key.update(f.read())
+        cache_filename = os.path.join(cache_dir, f'basinmap_v2_{key.hexdigest()}.npz')
+
+    if cache_filename is not None and os.path.exists(cache_filename):
+        basin_index, region_index = _load_basin_indices(cache_filename, basin_column, region_column)
+    else:
+        basin_index, region_index = _compute_basin_indices(np.frombuffer(x_bytes), np.frombuffer(y_bytes), shape_filename, basin_column, region_column, projection)
+        if cache_filename is not None and _can_save_basin_indices(basin_index, region_index):
+            _save_basin_indices(cache_filename, basin_index, region_index)
+
+    # The cached arrays are shared between calls
+    for index in (basin_index, region_index):
+        if index is not None:
+            index[0].flags.writeable = False
+            index[1].flags.writeable = False
+
+    return basin_index, region_index
+
+
+def _load_basin_indices(cache_filename, basin_column, region_column):
+    with np.load(cache_filename) as npz:
+        basin_index = (npz['basin_flat_idx'], npz['basin_code'], _load_label_names(npz, 'basin', basin_column))
+        region_index = None
+        if region_column is not None:
+            region_index = (npz['region_flat_idx'], npz['region_code'], _load_label_names(npz, 'region', region_column))
+    return basin_index, region_index
+
+
+def _load_label_names(npz, prefix, label_column):
+    # (cast back to the dtype of the shapefile's labels, so a cache hit returns the same index as a miss)
+    return pd.Index(npz[f'{prefix}_names'], dtype=str(npz[f'{prefix}_names_dtype']), name=label_column)
+
+
+# Only string and numeric labels round-trip through the cache file
+def _can_save_basin_indices(basin_index, region_index):
+    for index in (basin_index, region_index):
+        if index is not None and index[2].dtype.kind not in 'biuf':
+            if not all(isinstance(name, str) for name in index[2]):
+                return False
+    return True
+
+
+def _save_basin_indices(cache_filename, basin_index, region_index):
+    arrays = {}
+    for prefix, index in (('basin', basin_index), ('region', region_index)):
+        if index is not None:
+            arrays[f'{prefix}_flat_idx'] = index[0]
+            arrays[f'{prefix}_code'] = index[1]
+            names = index[2]
+            arrays[f'{prefix}_names'] = names.to_numpy() if names.dtype.kind in 'biuf' else np.array(names, dtype=str)
+            arrays[f'{prefix}_names_dtype'] = np.array(str(names.dtype))
+
+    # Write to a temporary file first so concurrent runs never load a partial file
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    tmp_filename = f'{cache_filename[:-4]}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, cache_filename)
+
+
+### Check whether the basins already have the coordinates they would have in the given projection
+## pyproj's equals is strict, so e.g. an ESRI .prj may not compare equal to the matching EPSG code on every PROJ version;
+## such CRSs are recognised by transforming a grid of points over the basins' bounds and finding no shift
+def _same_coordinates(basins_gdf, projection, tolerance=1e-6):
+    if basins_gdf.crs.equals(projection):
+        return True
+
+    minx, miny, maxx, maxy = basins_gdf.total_bounds
+    x, y = np.meshgrid(np.linspace(minx, maxx, 5), np.linspace(miny, maxy, 5))
+    transformer = pyproj.Transformer.from_crs(basins_gdf.crs, projection, always_xy=True)
+    x_new, y_new = transformer.transform(x.ravel(), y.ravel())
+    return max(np.max(np.abs(x_new - x.ravel())), np.max(np.abs(y_new - y.ravel()))) < tolerance
+
+
+def _compute_basin_indices(x_coords, y_coords, shape_filename, basin_column, region_column, projection=None):
+    # Load basin shapefile 
+    if pyogrio is not None:
+        basins_gdf = gpd.read_file(shape_filename, engine='pyogrio')
+    else:
+        basins_gdf = gpd.read_file(shape_filename)
+
+    # Bring the basins onto the model grid's projection (the grid stays regular in x and y, so the polygons are
+    # reprojected rather than the points)
+    if projection is not None and basins_gdf.crs is not None and not _same_coordinates(basins_gdf, projection):
+        basins_gdf = basins_gdf.to_crs(projection)
+
+    # Find the grid points inside the basins
+    flat_idx, basin_row = _points_in_basins(x_coords, y_coords, basins_gdf)
+
+    # Encode the basin (and region) of each point as an integer code
+    basin_index = _encode_basin_labels(flat_idx, basin_row, basins_gdf, basin_column)
+    region_index = None
+    if region_column is not None:
+        region_index = _encode_basin_labels(flat_idx, basin_row, basins_gdf, region_column)
+
+    return basin_index, region_index
+
+
+### Interpolate the model to each target time, yielding the flattened (y, x) grids in order
+## Targets are interpolated in blocks, so each block reads the model time steps around it in one call
+def _interp_time_blocks(lithk, targets, block_size=_INTERP_TIME_BLOCK):
+    for k in range(0, len(targets), block_size):
+        block = targets[k:k+block_size]
+        # (the grid is flattened in its (y, x) order, so the reshape is a view rather than a transposed copy)
+        yield from lithk.interp(time=block).transpose('time', 'y', 'x').values.reshape(len(block), -1)
+
+
+### Mass change of one time step relative to the start, with NaNs set to zero and scaled to Gt
+## Writes the mass change into out and returns its total
+def _mass_delta(lithk_current, lithk_start, scale, out):
+    np.subtract(lithk_current, lithk_start, out=out)
+    np.nan_to_num(out, copy=False)
+    out *= scale
+    # The NaNs are already replaced, so a plain sum avoids a second isnan pass over the grid
+    return out.sum(dtype=np.float64)
+
+
+### Sum values at the flattened grid positions by their integer label code
+def _bincount_sums(values_flat, flat_idx, label_code, n_labels):
+    return np.bincount(label_code, weights=values_flat[flat_idx], minlength=n_labels)
+
+
+if numba is not None:
+    # Single pass over the grid: difference, NaN fill, scaling and total are fused
+    # (no fastmath: it would let the compiler drop the NaN check)
+    @njit(parallel=True, cache=True)
+    def _mass_delta(lithk_current, lithk_start, scale, out):
+        total = 0.0
+        for i in prange(out.size):
+            d = lithk_current[i] - lithk_start[i]
+            if np.isnan(d):
+                d = 0.0
+            d *= scale
+            out[i] = d
+            total += d
+        return total
+
+    # Each thread accumulates a contiguous chunk of the joined points into its own row of partial sums
+    # (the number of chunks is passed in: calling numba.get_num_threads inside the kernel would stop it being cached)
+    @njit(parallel=True, cache=True)
+    def _bincount_sums_kernel(values_flat, flat_idx, label_code, n_labels, n_chunks):
+        chunk_size = (flat_idx.size + n_chunks - 1) // n_chunks
+        partial_sums = np.zeros((n_chunks, n_labels))
+        for c in prange(n_chunks):
+            for k in range(c*chunk_size, min((c+1)*chunk_size, flat_idx.size)):
+                partial_sums[c, label_code[k]] += values_flat[flat_idx[k]]
+        return partial_sums.sum(axis=0)
+
+    def _bincount_sums(values_flat, flat_idx, label_code, n_labels):
+        return _bincount_sums_kernel(values_flat, flat_idx, label_code, n_labels, numba.get_num_threads())
+
+
+### Sum gridded values by basin using the precomputed point-to-basin codes
+def _sum_by_basin(values_flat, flat_idx, label_code, label_names):
+    sums = _bincount_sums(values_flat, flat_idx, label_code, len(label_names))
+    return pd.Series(sums, index=label_names, name='lithk_delta')
+
 
 
 
@@ -15,16 +275,18 @@ from datetime import timedelta
 ## Interpolate the data to each IMBIE time and calculate the time varying mass change
 def process_model_data(mod_ds,time_var, IMBIE_total_mass_change_sum, \
                        start_date_cftime, end_date_cftime, start_date_fract, end_date_fract, \
-                       rho_ice, projection, shape_filename, icesheet):
+                       rho_ice, projection, shape_filename, icesheet, cache_dir=None):
     
     # Model data
     lithk = mod_ds['lithk']
     
-    lithk['time'] = [date.year + (date.dayofyr-1) / days_in_year(date) for date in time_var.data]
+    # Convert the model times to fractional years
+    model_dates = time_var.data
+    years = np.fromiter((date.year for date in model_dates), dtype=np.float64, count=len(model_dates))
+    doys = np.fromiter((date.dayofyr for date in model_dates), dtype=np.float64, count=len(model_dates))
+    diys = np.fromiter((days_in_year(date) for date in model_dates), dtype=np.float64, count=len(model_dates))
+    lithk['time'] = years + (doys-1) / diys
 
-    # Load basin shapefile 
-    basins_gdf = gpd.read_file(shape_filename)
-    
     # Check the selcted dates are within the range of model data
     check_datarange(time_var,start_date_cftime, end_date_cftime)
         
@@ -38,75 +300,41 @@ def process_model_data(mod_ds,time_var, IMBIE_total_mass_change_sum, \
     x_resolution = abs(x_coords[1] - x_coords[0])
     y_resolution = abs(y_coords[1] - y_coords[0])
     
-    # Create a list of Point geometries from coordinate grids
-    points = [Point(x, y) for x in x_coords for y in y_coords]
+    # Map the grid points to the basins only once; the point-to-basin mapping does not change with time
+    # (pass cache_dir to also keep the mapping on disk for later sessions)
+    basin_index, region_index = _basin_indices(x_coords, y_coords, shape_filename, icesheet, cache_dir, projection)
     
     # Initialize a dictionary to store residuals
     model_mass_change = {}
     
-    # Interpolate limnsw at the start date (initial reference)
-    lithk_start = lithk.interp(time=start_date_fract).data.transpose().flatten()
-    
-    # Loop through each filtered time step to calculate the residual
-    for i, time_step in enumerate(filtered_time_var):
-     
-        # Interpolate limnsw at the current time_step
-        lithk_current = lithk.interp(time=time_step).data.transpose().flatten()
-        
-        # Calculate the residual (difference from start)
-        lithk_delta = lithk_current - lithk_start
-    
-        lithk_delta[np.isnan(lithk_delta)] = 0
+    # Interpolate lithk at the start date (initial reference)
+    lithk_start = lithk.interp(time=start_date_fract).transpose('y', 'x').values.ravel()
+
+    # Scale from thickness change to mass change (Gt) with area = x_resolution*y_resolution (in float64, the grid coordinates may be float32)
+    scale = np.float64(x_resolution)*y_resolution*rho_ice * 1e-12
+    lithk_delta = np.empty(lithk_start.size)
     
-        #calculate area = x_resolution*y_resolution
-        lithk_delta = (lithk_delta * x_resolution*y_resolution)*rho_ice * 1e-12
+    # Loop through each filtered time step, with lithk interpolated at that time step, to calculate the residual
+    for time_step, lithk_current in zip(filtered_time_var, _interp_time_blocks(lithk, filtered_time_var.values)):
 
         ## TOTAL AREA
-        # Sum all of the area mass change
-        model_total_mass_balance_unmasked= np.nansum(lithk_delta)
+        # Calculate the residual (difference from start) and sum all of the area mass change
+        model_total_mass_balance_unmasked = _mass_delta(lithk_current, lithk_start, scale, lithk_delta)
                
         ## BASIN AREA
-        # Sum all of the basin mass change
-        lithk_delta_flat = lithk_delta.flatten()
-        
-        # Create a lithk_df DataFrame with Geometry and Values
-        lithk_df = pd.DataFrame({
-            'geometry': points,
-            'lithk_delta': lithk_delta_flat
-        })
-    
-        # Convert lithk_df DataFrame to lithk_gdf GeoDataFrame
-        lithk_gdf = gpd.GeoDataFrame(lithk_df, geometry='geometry', crs=projection)    
-        
-    
-        # Perform the spatial join only once in the first iteration
-        if i == 0:
-            joined_gdf = gpd.sjoin(lithk_gdf, basins_gdf, how="inner", predicate='intersects')
-    
-    
-        # Update the lithk_delta in joined_gdf
-        joined_gdf['lithk_delta'] = lithk_gdf['lithk_delta']
-           
-        # Sum lithk_delta values by basin
-        if icesheet == "GIS":
-             # Sum lithk_delta values by subregion column
-            basin_mass_change_sums = joined_gdf.groupby('SUBREGION1')['lithk_delta'].sum()
-            # Sum lithk_delta values by the 'Regions' column
-            region_mass_change_sums = None  # No regions for Greenland
-        elif icesheet == "AIS":
-            # Sum lithk_delta values by subregion column
-            basin_mass_change_sums = joined_gdf.groupby('Subregion')['lithk_delta'].sum()
-            # Sum lithk_delta values by the 'Regions' column
-            region_mass_change_sums = joined_gdf.groupby('Regions')['lithk_delta'].sum()
+        # Sum lithk_delta values by basin (and by region for Antarctica)
+        basin_mass_change_sums = _sum_by_basin(lithk_delta, *basin_index)
+        if region_index is not None:
+            region_mass_change_sums = _sum_by_basin(lithk_delta, *region_index)
         else:
-            raise ValueError("Invalid iceshee value. Must be 'GIS' or 'AIS'.")
+            region_mass_change_sums = None
         
         # Sum all of the basin mass change
         model_total_mass_balance_masked = basin_mass_change_sums.sum()
           
 
-        # Store the residual in the dictionary for the current time step
-        model_mass_change[str(time_step)] = {
+        # Store the residual in the dictionary for the current time step (keyed on the fractional year)
+        model_mass_change[float(time_step)] = {
             'model_total_mass_balance_unmasked': model_total_mass_balance_unmasked,
             'model_total_mass_balance_masked': model_total_mass_balance_masked,
             'basin_mass_change_sums': basin_mass_change_sums,
@@ -120,56 +348,58 @@ def process_model_data(mod_ds,time_var, IMBIE_total_mass_change_sum, \
 
 
 
-### Extract time varying IMBIE mass balance data and calculate the time varying mass difference 
-def process_imbie_data(obs_filename,start_date_fract,end_date_fract,mass_balance_column):
-
-    # Load the CSV file
-    mass_balance_data = pd.read_csv(obs_filename)
-    
-    # Column names
-    date_column = 'Year'
-    
-    # Ensure the 'Year' column is treated as float to capture the fractional year part
-    mass_balance_data['Year'] = mass_balance_data['Year'].astype(float)
-    
-
-    # Sort the data by 'Date' column to ensure it’s in increasing order of both year and fraction
-    mass_balance_data = mass_balance_data.sort_values(by='Year')
-        
+### Load the 'Year' and mass balance columns of an IMBIE CSV file, sorted by year, with their CSV row labels
+## Cached on the file's modification time so repeated calls for other date windows skip the CSV parsing
+@functools.lru_cache(maxsize=32)
+def _load_imbie_columns(obs_filename, mtime, mass_balance_column):
 
+    # Load only the date and mass balance columns of the CSV file, with the 'Year' column parsed as float to capture the fractional year part
+    mass_balance_data = pd.read_csv(obs_filename, usecols=lambda column: column in ('Year', mass_balance_column),
+                                    dtype={'Year': np.float64, mass_balance_column: np.float64})
     
     # Check if the column exists in the DataFrame
     if mass_balance_column not in mass_balance_data.columns:
         raise ValueError(f"Error: The column '{mass_balance_column}' does not exist in the CSV file.")
     
+    # Sort the data by 'Year' column to ensure it’s in increasing order of both year and fraction (IMBIE files already are)
+    years = mass_balance_data['Year'].to_numpy()
+    if np.any(years[1:] < years[:-1]):
+        mass_balance_data = mass_balance_data.sort_values(by='Year')
     
+    rows = mass_balance_data.index.to_numpy(copy=True)
+    years = mass_balance_data['Year'].to_numpy(copy=True)
+    mass_balance = mass_balance_data[mass_balance_column].to_numpy(copy=True)
+
+    # The arrays are shared between calls, so keep them read-only
+    rows.flags.writeable = False
+    years.flags.writeable = False
+    mass_balance.flags.writeable = False
+
+    return rows, years, mass_balance
+
+
+### Extract time varying IMBIE mass balance data and calculate the time varying mass difference 
+def process_imbie_data(obs_filename,start_date_fract,end_date_fract,mass_balance_column):
+
+    rows, years, mass_balance = _load_imbie_columns(os.path.abspath(obs_filename), os.path.getmtime(obs_filename), mass_balance_column)
+
     # Get the initial mass balance value for the start date
-    data_start_date = mass_balance_data[mass_balance_data['Year'] == start_date_fract]
-    if data_start_date.empty:
+    start_idx = np.flatnonzero(years == start_date_fract)
+    if start_idx.size == 0:
         raise ValueError(f"Error: No data available for the start date {start_date_fract}.")
-    mass_balance_start_value = data_start_date[mass_balance_column].iloc[0]  # value of start date
+    mass_balance_start_value = mass_balance[start_idx[0]]  # value of start date
     
     # Filter data between start_date_converted and end_date_converted (inclusive)
-    filtered_data = mass_balance_data[
-        (mass_balance_data['Year'] > start_date_fract) & (mass_balance_data['Year'] <= end_date_fract)
-    ].copy()
-    
-    
-    # Initialize the previous date's mass balance value to the starting mass balance
-    previous_mass_balance = mass_balance_start_value
+    filtered_idx = np.flatnonzero((years > start_date_fract) & (years <= end_date_fract))
     
-    # Calculate monthly mass change from the previous date for each time step
-    mass_changes = []  # To store the daily mass changes
+    # Calculate the mass change from the start date's balance for each time step
+    mass_changes = mass_balance[filtered_idx] - mass_balance_start_value
     
-    for index, row in filtered_data.iterrows():
-        current_mass_balance = row[mass_balance_column]
-        # Calculate the change from the previous date's balance
-        mass_change = current_mass_balance-previous_mass_balance
-        mass_changes.append(mass_change)
-   
-    
-    # Assign the calculated mass changes to a new column in the DataFrame
-    filtered_data['IMBIE_Mass_Change'] = mass_changes
+    # Build a new DataFrame from the filtered rows and the calculated mass changes (indexed by their CSV row labels)
+    filtered_data = pd.DataFrame({'Year': years[filtered_idx],
+                                  mass_balance_column: mass_balance[filtered_idx],
+                                  'IMBIE_Mass_Change': mass_changes},
+                                 index=rows[filtered_idx])
 
 
     return filtered_data
@@ -191,15 +421,15 @@ def calculate_model_imbie_residuals(start_date_fract, end_date_fract, \
         imbie_mass_change = row['IMBIE_Mass_Change']
         
         # Check if the date exists in basin_result
-        if str(date) in basin_result:
-            model_mass_change_masked = basin_result[str(date)]['model_total_mass_balance_masked']
-            model_mass_change_unmasked = basin_result[str(date)]['model_total_mass_balance_unmasked']
+        if float(date) in basin_result:
+            model_mass_change_masked = basin_result[float(date)]['model_total_mass_balance_masked']
+            model_mass_change_unmasked = basin_result[float(date)]['model_total_mass_balance_unmasked']
             # Calculate the delta
             delta_masschange_masked  = imbie_mass_change - model_mass_change_masked 
             delta_masschange_unmasked  = imbie_mass_change - model_mass_change_unmasked 
             
             # Store results in the dictionary
-            results[str(date)] = {
+            results[float(date)] = {
                 'IMBIE_total_mass_change_sum': imbie_mass_change,
                 'Delta_MassChange_masked': delta_masschange_masked,
                 'Delta_MassChange_unmasked': delta_masschange_unmasked
@@ -239,13 +469,13 @@ def calculate_model_imbie_residuals(start_date_fract, end_date_fract, \
                 
                 
                 # Check if the date exists in basin_result
-                if str(date) in basin_result:
-                    region_mass_change_sums = basin_result[str(date)]['region_mass_change_sums']
+                if float(date) in basin_result:
+                    region_mass_change_sums = basin_result[float(date)]['region_mass_change_sums']
                     
                     # East region
                     if 'East' in region_mass_change_sums:
                         delta_masschange_east = imbie_mass_change_east - region_mass_change_sums['East']
-                        regional_results.setdefault(str(date), {}).update({
+                        regional_results.setdefault(float(date), {}).update({
                             'IMBIE_Mass_Change_East': imbie_mass_change_east,
                             'Delta_MassChange_East': delta_masschange_east
                         })
@@ -253,7 +483,7 @@ def calculate_model_imbie_residuals(start_date_fract, end_date_fract, \
                     # West region
                     if 'West' in region_mass_change_sums:
                         delta_masschange_west = imbie_mass_change_west - region_mass_change_sums['West']
-                        regional_results.setdefault(str(date), {}).update({
+                        regional_results.setdefault(float(date), {}).update({
                             'IMBIE_Mass_Change_West': imbie_mass_change_west,
                             'Delta_MassChange_West': delta_masschange_west
                         })
@@ -261,7 +491,7 @@ def calculate_model_imbie_residuals(start_date_fract, end_date_fract, \
                     # Peninsula region
                     if 'Peninsula' in region_mass_change_sums:
                         delta_masschange_peninsula = imbie_mass_change_peninsula - region_mass_change_sums['Peninsula']
-                        regional_results.setdefault(str(date), {}).update({
+                        regional_results.setdefault(float(date), {}).update({
                             'IMBIE_Mass_Change_Peninsula': imbie_mass_change_peninsula,
                             'Delta_MassChange_Peninsula': delta_masschange_peninsula
                         })
@@ -278,11 +508,23 @@ def calculate_model_imbie_residuals(start_date_fract, end_date_fract, \
 
 
 
-def write_and_display_mass_change_comparison_all_dates(icesheet, basin_result, results, mass_balance_type,start_date_fract,end_date_fract, csv_filename):
+# Shared empty lookup for dates without regional results
+_EMPTY = types.MappingProxyType({})
+
+
+### Format a mass change (Gt) for the comparison table, '--' if it is not available
+def _format_mass_change(value):
+    return f"{value:.2f}" if isinstance(value, (float, int)) else "--"
+
+
+### Write the time-varying mass change comparison to a CSV file, and also print the totals if verbose
+def _write_mass_change_comparison(icesheet, basin_result, results, mass_balance_type, start_date_fract, end_date_fract, csv_filename, verbose):
     # Initialize list to store rows of data for CSV
     data_rows = []
 
     print_regionalresult_check = results.get('print_regionalresult_check')
+    print_regions = icesheet == "AIS" and print_regionalresult_check == 'YES'
+    regional_results = results.get('Regional_Mass_Change_Summary', _EMPTY)
     
     # Add mass change comparison header
     data_rows.append([f"Mass change comparison ({mass_balance_type})", f"{start_date_fract} - {end_date_fract}"])
@@ -291,19 +533,20 @@ def write_and_display_mass_change_comparison_all_dates(icesheet, basin_result, r
     # Determine basins and regions from the first available date after the start_date
     basins = []
     regions = []
-    for date in sorted(basin_result.keys()):
-        if float(date) > start_date_fract:
-            basins = list(basin_result[date].get('basin_mass_change_sums', {}).keys())
-            if icesheet == "AIS" and print_regionalresult_check == 'YES':
-                regions = list(basin_result[date].get('region_mass_change_sums', {}).keys())
-            break
+    sorted_dates = np.sort(np.fromiter(basin_result.keys(), dtype=np.float64, count=len(basin_result)))
+    i_first = np.searchsorted(sorted_dates, start_date_fract, side='right')
+    if i_first < len(sorted_dates):
+        date = float(sorted_dates[i_first])
+        basins = list(basin_result[date].get('basin_mass_change_sums', {}).keys())
+        if print_regions:
+            regions = list(basin_result[date].get('region_mass_change_sums', {}).keys())
 
     # Add rows for each basin with zero values for the start_date
     for basin in basins:
         data_rows.append([start_date_fract, basin, "0.00", "--", "--"])
 
     # Add rows for each region with zero values for the start_date (if applicable)
-    if icesheet == "AIS" and print_regionalresult_check == 'YES':
+    if print_regions:
         for region in regions:
             data_rows.append([start_date_fract, region, "0.00", "0.00", "0.00"])
 
@@ -312,158 +555,62 @@ def write_and_display_mass_change_comparison_all_dates(icesheet, basin_result, r
     data_rows.append([start_date_fract, 'Unmasked_Total', "0.00", "0.00", "0.00"])
  
 
-    print(f"\n Time-varying Mass change comparison ({mass_balance_type}): {start_date_fract} - {end_date_fract}")
-    print(f"{'Date':<15} {'Basin/Region':<20} {'Model mass change (Gt)':<25} {'IMBIE mass change (Gt)':<25} {'Residual (Gt)':<20}")
-    model_total_mass_balance_masked=0.00
-    imbie_total_mass_change_sum=0.00
-    delta_masschange_masked=0.00
-    
-    print(f"{start_date_fract:<15} {'Masked_Total':<20} {model_total_mass_balance_masked :<25} {imbie_total_mass_change_sum:<25} {delta_masschange_masked :<20}")
+    if verbose:
+        print(f"\n Time-varying Mass change comparison ({mass_balance_type}): {start_date_fract} - {end_date_fract}")
+        print(f"{'Date':<15} {'Basin/Region':<20} {'Model mass change (Gt)':<25} {'IMBIE mass change (Gt)':<25} {'Residual (Gt)':<20}")
+        model_total_mass_balance_masked=0.00
+        imbie_total_mass_change_sum=0.00
+        delta_masschange_masked=0.00
+        print(f"{start_date_fract:<15} {'Masked_Total':<20} {model_total_mass_balance_masked :<25} {imbie_total_mass_change_sum:<25} {delta_masschange_masked :<20}")
     
 
     # Process the rest of the dates
     for date, result in results.items():
-        if date in basin_result:
-            # Basin mass change sums
-            basin_mass_change_sums = basin_result[date].get('basin_mass_change_sums', {})
-
-            for basin, model_mass_change in basin_mass_change_sums.items():
-                imbie_mass_change = '--'
-                residual_mass_change = '--'
-                data_rows.append([date, basin, f"{model_mass_change:.2f}", imbie_mass_change, residual_mass_change])
-
-            if icesheet == "AIS" and print_regionalresult_check == 'YES':
-                # Regional mass change sums
-                region_mass_change_sums = basin_result[date].get('region_mass_change_sums', {})
-                for region, model_mass_change in region_mass_change_sums.items():
-                    imbie_mass_change = results.get('Regional_Mass_Change_Summary', {}).get(date, {}).get(f'IMBIE_Mass_Change_{region}', '--')
-                    residual_mass_change = results.get('Regional_Mass_Change_Summary', {}).get(date, {}).get(f'Delta_MassChange_{region}', '--')
+        model_result = basin_result.get(date)
+        if model_result is None:
+            continue
+
+        # Basin mass change sums
+        for basin, model_mass_change in model_result.get('basin_mass_change_sums', _EMPTY).items():
+            data_rows.append([date, basin, f"{model_mass_change:.2f}", '--', '--'])
+
+        if print_regions:
+            # Regional mass change sums
+            regional_result = regional_results.get(date) or _EMPTY
+            for region, model_mass_change in model_result.get('region_mass_change_sums', _EMPTY).items():
+                imbie_mass_change = _format_mass_change(regional_result.get(f'IMBIE_Mass_Change_{region}', '--'))
+                residual_mass_change = _format_mass_change(regional_result.get(f'Delta_MassChange_{region}', '--'))
+                data_rows.append([date, region, f"{model_mass_change:.2f}", imbie_mass_change, residual_mass_change])
         
-                    imbie_mass_change = f"{imbie_mass_change:.2f}" if isinstance(imbie_mass_change, (float, int)) else "--"
-                    residual_mass_change = f"{residual_mass_change:.2f}" if isinstance(residual_mass_change, (float, int)) else "--"
-                    data_rows.append([date, region, f"{model_mass_change:.2f}", imbie_mass_change, residual_mass_change])
-            
-            # Total mass balance masked
-            model_total_mass_balance_masked = basin_result[date].get('model_total_mass_balance_masked', '--')   
-            imbie_total_mass_change_sum = result.get('IMBIE_total_mass_change_sum', '--')
-            delta_masschange_masked  = result.get('Delta_MassChange_masked', '--')
-    
-            model_total_mass_balance_masked  = f"{model_total_mass_balance_masked :.2f}" if isinstance(model_total_mass_balance_masked , (float, int)) else "--"
-            imbie_total_mass_change_sum = f"{imbie_total_mass_change_sum:.2f}" if isinstance(imbie_total_mass_change_sum, (float, int)) else "--"
-            delta_masschange_masked  = f"{delta_masschange_masked :.2f}" if isinstance(delta_masschange_masked , (float, int)) else "--"
-            data_rows.append([date, 'Masked_Total', model_total_mass_balance_masked , imbie_total_mass_change_sum, delta_masschange_masked ]) 
+        imbie_total_mass_change_sum = _format_mass_change(result.get('IMBIE_total_mass_change_sum', '--'))
+
+        # Total mass balance masked
+        model_total_mass_balance_masked = _format_mass_change(model_result.get('model_total_mass_balance_masked', '--'))
+        delta_masschange_masked = _format_mass_change(result.get('Delta_MassChange_masked', '--'))
+        data_rows.append([date, 'Masked_Total', model_total_mass_balance_masked, imbie_total_mass_change_sum, delta_masschange_masked])
+        if verbose:
             print(f"{date:<15} {'Masked_Total':<20} {model_total_mass_balance_masked :<25} {imbie_total_mass_change_sum:<25} {delta_masschange_masked :<20}")
 
-            # Total mass balance unmasked
-            model_total_mass_balance_unmasked = basin_result[date].get('model_total_mass_balance_unmasked', '--')
-            imbie_total_mass_change_sum = result.get('IMBIE_total_mass_change_sum', '--')
-            delta_masschange_unmasked = result.get('Delta_MassChange_unmasked', '--')
-        
-        
-            model_total_mass_balance_unmasked = f"{model_total_mass_balance_unmasked:.2f}" if isinstance(model_total_mass_balance_unmasked, (float, int)) else "--"
-            imbie_total_mass_change_sum = f"{imbie_total_mass_change_sum:.2f}" if isinstance(imbie_total_mass_change_sum, (float, int)) else "--"
-            delta_masschange_unmasked = f"{delta_masschange_unmasked:.2f}" if isinstance(delta_masschange_unmasked, (float, int)) else "--"
-            data_rows.append([date, 'Unmasked_Total', model_total_mass_balance_unmasked, imbie_total_mass_change_sum, delta_masschange_unmasked])
+        # Total mass balance unmasked
+        model_total_mass_balance_unmasked = _format_mass_change(model_result.get('model_total_mass_balance_unmasked', '--'))
+        delta_masschange_unmasked = _format_mass_change(result.get('Delta_MassChange_unmasked', '--'))
+        data_rows.append([date, 'Unmasked_Total', model_total_mass_balance_unmasked, imbie_total_mass_change_sum, delta_masschange_unmasked])
 
-    # Convert the data rows into a pandas DataFrame
-    df = pd.DataFrame(data_rows)
-    
-    # Write the DataFrame to a CSV file
+    # Write the rows to the CSV file, padding the shorter header rows to the full table width
     print(f"\nWriting data to CSV file: {csv_filename}")
-    df.to_csv(csv_filename, index=False, header=False)
-
-
-
-
-def write_mass_change_comparison_all_dates(icesheet, basin_result, results, mass_balance_type,start_date_fract,end_date_fract, csv_filename):
-    # Initialize list to store rows of data for CSV
-    data_rows = []
-
-    print_regionalresult_check = results.get('print_regionalresult_check')
-    
-    # Add mass change comparison header
-    data_rows.append([f"Mass change comparison ({mass_balance_type})", f"{start_date_fract} - {end_date_fract}"])
-    data_rows.append(['Date', 'Basin/Region', 'Model mass change (Gt)', 'IMBIE mass change (Gt)', 'Residual (Gt)'])
-
-    # Determine basins and regions from the first available date after the start_date
-    basins = []
-    regions = []
-    for date in sorted(basin_result.keys()):
-        if float(date) > start_date_fract:
-            basins = list(basin_result[date].get('basin_mass_change_sums', {}).keys())
-            if icesheet == "AIS" and print_regionalresult_check == 'YES':
-                regions = list(basin_result[date].get('region_mass_change_sums', {}).keys())
-            break
-
-    # Add rows for each basin with zero values for the start_date
-    for basin in basins:
-        data_rows.append([start_date_fract, basin, "0.00", "--", "--"])
+    n_columns = max(len(row) for row in data_rows)
+    with open(csv_filename, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerows(row + [''] * (n_columns - len(row)) for row in data_rows)
 
-    # Add rows for each region with zero values for the start_date (if applicable)
-    if icesheet == "AIS" and print_regionalresult_check == 'YES':
-        for region in regions:
-            data_rows.append([start_date_fract, region, "0.00", "0.00", "0.00"])
 
-    # Add totals (masked and unmasked) with zero values for the start_date
-    data_rows.append([start_date_fract, 'Masked_Total', "0.00", "0.00", "0.00"])
-    data_rows.append([start_date_fract, 'Unmasked_Total', "0.00", "0.00", "0.00"])
- 
-
-    model_total_mass_balance_masked=0.00
-    imbie_total_mass_change_sum=0.00
-    delta_masschange_masked=0.00
-    
 
-    # Process the rest of the dates
-    for date, result in results.items():
-        if date in basin_result:
-            # Basin mass change sums
-            basin_mass_change_sums = basin_result[date].get('basin_mass_change_sums', {})
-
-            for basin, model_mass_change in basin_mass_change_sums.items():
-                imbie_mass_change = '--'
-                residual_mass_change = '--'
-                data_rows.append([date, basin, f"{model_mass_change:.2f}", imbie_mass_change, residual_mass_change])
-
-            if icesheet == "AIS" and print_regionalresult_check == 'YES':
-                # Regional mass change sums
-                region_mass_change_sums = basin_result[date].get('region_mass_change_sums', {})
-                for region, model_mass_change in region_mass_change_sums.items():
-                    imbie_mass_change = results.get('Regional_Mass_Change_Summary', {}).get(date, {}).get(f'IMBIE_Mass_Change_{region}', '--')
-                    residual_mass_change = results.get('Regional_Mass_Change_Summary', {}).get(date, {}).get(f'Delta_MassChange_{region}', '--')
-        
-                    imbie_mass_change = f"{imbie_mass_change:.2f}" if isinstance(imbie_mass_change, (float, int)) else "--"
-                    residual_mass_change = f"{residual_mass_change:.2f}" if isinstance(residual_mass_change, (float, int)) else "--"
-                    data_rows.append([date, region, f"{model_mass_change:.2f}", imbie_mass_change, residual_mass_change])
-            
-            # Total mass balance masked
-            model_total_mass_balance_masked = basin_result[date].get('model_total_mass_balance_masked', '--')   
-            imbie_total_mass_change_sum = result.get('IMBIE_total_mass_change_sum', '--')
-            delta_masschange_masked  = result.get('Delta_MassChange_masked', '--')
-    
-            model_total_mass_balance_masked  = f"{model_total_mass_balance_masked :.2f}" if isinstance(model_total_mass_balance_masked , (float, int)) else "--"
-            imbie_total_mass_change_sum = f"{imbie_total_mass_change_sum:.2f}" if isinstance(imbie_total_mass_change_sum, (float, int)) else "--"
-            delta_masschange_masked  = f"{delta_masschange_masked :.2f}" if isinstance(delta_masschange_masked , (float, int)) else "--"
-            data_rows.append([date, 'Masked_Total', model_total_mass_balance_masked , imbie_total_mass_change_sum, delta_masschange_masked ]) 
-
-            # Total mass balance unmasked
-            model_total_mass_balance_unmasked = basin_result[date].get('model_total_mass_balance_unmasked', '--')
-            imbie_total_mass_change_sum = result.get('IMBIE_total_mass_change_sum', '--')
-            delta_masschange_unmasked = result.get('Delta_MassChange_unmasked', '--')
-        
-        
-            model_total_mass_balance_unmasked = f"{model_total_mass_balance_unmasked:.2f}" if isinstance(model_total_mass_balance_unmasked, (float, int)) else "--"
-            imbie_total_mass_change_sum = f"{imbie_total_mass_change_sum:.2f}" if isinstance(imbie_total_mass_change_sum, (float, int)) else "--"
-            delta_masschange_unmasked = f"{delta_masschange_unmasked:.2f}" if isinstance(delta_masschange_unmasked, (float, int)) else "--"
-            data_rows.append([date, 'Unmasked_Total', model_total_mass_balance_unmasked, imbie_total_mass_change_sum, delta_masschange_unmasked])
 
-    # Convert the data rows into a pandas DataFrame
-    df = pd.DataFrame(data_rows)
-    
-    # Write the DataFrame to a CSV file
-    print(f"\nWriting data to CSV file: {csv_filename}")
-    df.to_csv(csv_filename, index=False, header=False)
+def write_and_display_mass_change_comparison_all_dates(icesheet, basin_result, results, mass_balance_type,start_date_fract,end_date_fract, csv_filename):
+    _write_mass_change_comparison(icesheet, basin_result, results, mass_balance_type, start_date_fract, end_date_fract, csv_filename, verbose=True)
 
 
 
 
+def write_mass_change_comparison_all_dates(icesheet, basin_result, results, mass_balance_type,start_date_fract,end_date_fract, csv_filename):
+    _write_mass_change_comparison(icesheet, basin_result, results, mass_balance_type, start_date_fract, end_date_fract, csv_filename, verbose=False)
@@ -1,59 +1,80 @@
 import numpy as np
 import xarray as xr
 import h5py
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+# Numba is optional: when it is not installed the NumPy version of the mascon loop below is used
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 class GSFCmascons:
     def __init__(self, f, lon_wrap='pm180'):
-        self.lat_centers = f['/mascon/lat_center'][0][:]
-        self.lat_spans = f['/mascon/lat_span'][0][:]
-        self.lon_centers = f['/mascon/lon_center'][0][:]
-        self.lon_spans = f['/mascon/lon_span'][0][:]
-        self.locations = f['/mascon/location'][0][:]
-        self.basins = f['/mascon/basin'][0][:]
-        self.areas = f['/mascon/area_km2'][0][:]
-        self.cmwe = f['/solution/cmwe'][:]
+        # (the group handles are looked up once for all of their datasets)
+        mascon_group = f['/mascon']
+        for name, attr in [('lat_center', 'lat_centers'), ('lat_span', 'lat_spans'), ('lon_center', 'lon_centers'),
+                           ('lon_span', 'lon_spans'), ('location', 'locations'), ('basin', 'basins'), ('area_km2', 'areas')]:
+            setattr(self, attr, self._read_first_row(mascon_group[name]))
+        # (stored time-major so the solution columns selected by calc_mascon_delta_cmwe are contiguous)
+        self.cmwe = np.asfortranarray(f['/solution/cmwe'][:])
         
-        self.days_start = f['/time/ref_days_first'][0][:]
-        self.days_middle = f['/time/ref_days_middle'][0][:]
-        self.days_end = f['/time/ref_days_last'][0][:]
-        self.times_start = self._set_times_as_datetimes(self.days_start)
-        self.times_middle = self._set_times_as_datetimes(self.days_middle)
-        self.times_end = self._set_times_as_datetimes(self.days_end)
+        time_group = f['/time']
+        for name, attr in [('ref_days_first', 'days_start'), ('ref_days_middle', 'days_middle'), ('ref_days_last', 'days_end')]:
+            setattr(self, attr, self._read_first_row(time_group[name]))
+        # (the three sets of days are converted together and split back into views)
+        all_times = self._set_times_as_datetimes(np.concatenate([self.days_start, self.days_middle, self.days_end]))
+        self.times_start, self.times_middle, self.times_end = np.split(all_times, np.cumsum([len(self.days_start), len(self.days_middle)]))
+        # (checked once so calc_mascon_delta_cmwe can go straight to a binary search)
+        self._times_start_sorted = bool(np.all(self.times_start[1:] >= self.times_start[:-1]))
+        self._times_end_sorted = bool(np.all(self.times_end[1:] >= self.times_end[:-1]))
 
         self.N_mascons = len(self.lat_centers)
         self.N_times = len(self.days_middle)
         self.labels = np.array([i for i in range(self.N_mascons)])
         
-        self.reset_lon_bounds(lon_wrap)
-        
         self.min_lats = self.lat_centers - self.lat_spans/2
         self.max_lats = self.lat_centers + self.lat_spans/2
         self.max_lats[self.min_lats < -90.0] = -89.5
         self.min_lats[self.min_lats < -90.0] = -90.0
         self.min_lats[self.max_lats > 90.0] = 89.5
         self.max_lats[self.max_lats > 90.0] = 90.0
-        self.min_lons = self.lon_centers - self.lon_spans/2
-        self.max_lons = self.lon_centers + self.lon_spans/2
+        
+        self.reset_lon_bounds(lon_wrap)
 
     def reset_lon_bounds(self, lon_wrap):
+        # (in place, without gathering and scattering the shifted centers)
         if lon_wrap == 'pm180':
-            self.lon_centers[self.lon_centers > 180] -= 360
+            np.subtract(self.lon_centers, 360, out=self.lon_centers, where=self.lon_centers > 180)
         elif lon_wrap == '0to360':
-            self.lon_centers[self.lon_centers < 0] += 360
+            np.add(self.lon_centers, 360, out=self.lon_centers, where=self.lon_centers < 0)
+        
+        # The longitude bounds follow the centers, so points_to_mascons sees the new wrap
+        self.min_lons = self.lon_centers - self.lon_spans/2
+        self.max_lons = self.lon_centers + self.lon_spans/2
+        
+        # The band lookup used by points_to_mascons is built here, once per wrap, rather than on every call
+        self._bands = _mascon_bands(self.min_lats, self.max_lats, self.min_lons, self.max_lons)
+
+    def _read_first_row(self, dataset):
+        # Read the first row of a (1, N) dataset straight into a new array
+        row = np.empty(dataset.shape[1:], dtype=dataset.dtype)
+        dataset.read_direct(row, source_sel=np.s_[0, ...])
+        return row
 
     def _set_times_as_datetimes(self, days):
-        return np.datetime64('2002-01-01T00:00:00') + np.array([int(d*24) for d in days], dtype='timedelta64[h]')
+        return np.datetime64('2002-01-01T00:00:00') + (np.asarray(days)*24).astype(np.int64).astype('timedelta64[h]')
     
     def as_dataset(self):
         ds = xr.Dataset({'cmwe': (['label', 'time'], self.cmwe),
                          'lat_centers': ('label', self.lat_centers),
                          'lat_spans': ('label', self.lat_spans),
                          'lon_centers': ('label', self.lon_centers),
-                         'lat_spans': ('label', self.lon_spans),
+                         'lon_spans': ('label', self.lon_spans),
                          'areas': ('label', self.areas),
                          'basins': ('label', self.basins),
                          'locations': ('label', self.locations),
-                         'basins': ('label', self.basins),
                          'lats_max': ('label', self.max_lats),
                          'lats_min': ('label', self.min_lats),
                          'lons_max': ('label', self.max_lons),
@@ -71,48 +92,206 @@ def load_gsfc_solution(h5_filename, lon_wrap='pm180'):
         mascons = GSFCmascons(f, lon_wrap)
     return mascons
 
-def points_to_mascons(mascons, lats, lons, values):
-    d2r = np.pi/180
+def load_gsfc_solutions(h5_filenames, lon_wrap='pm180', n_workers=None):
+    # Load several solution files in worker processes (HDF5 serializes reads from threads)
+    h5_filenames = list(h5_filenames)
+    if len(h5_filenames) < 2 or n_workers == 1:
+        return [load_gsfc_solution(h5_filename, lon_wrap) for h5_filename in h5_filenames]
+    
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(load_gsfc_solution, h5_filenames, itertools.repeat(lon_wrap)))
+
+# Fall back to testing every mascon when a point may lie in more overlapping boxes than this
+_MAX_OVERLAP_DEPTH = 4
+
+def _sorted_intervals(starts, ends, ids):
+    # Intervals [start, end) sorted by start, with the number of earlier intervals that can
+    # still overlap a later one (the mascon boxes share edges only up to rounding)
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    first = np.searchsorted(np.maximum.accumulate(ends), starts, side='right')
+    depth = max(0, int(np.max(np.arange(len(starts)) - first)))
+    return starts, ends, ids[order], depth
+
+def _intervals_containing(intervals, x):
+    # (position in x, interval id) pairs for every interval containing each x
+    starts, ends, ids, depth = intervals
+    j = np.searchsorted(starts, x, side='right') - 1
+    points = []
+    found = []
+    for d in range(depth + 1):
+        k = j - d
+        I_ = np.flatnonzero(k >= 0)
+        I_ = I_[x[I_] < ends[k[I_]]]
+        points.append(I_)
+        found.append(ids[k[I_]])
+    return np.concatenate(points), np.concatenate(found)
+
+def _mascon_bands(min_lats, max_lats, min_lons, max_lons):
+    # Group the mascons into latitude bands of identical bounds, with the mascons of each band
+    # as longitude intervals. Returns None when the boxes overlap too much for a binary search
+    # to find the few boxes a point falls in. Empty boxes cannot contain any point and are left out.
+    keep = np.flatnonzero((min_lats < max_lats) & (min_lons < max_lons))
+    if len(keep) == 0:
+        return None
+    bounds, band = np.unique(np.stack([min_lats[keep], max_lats[keep]], axis=1), axis=0, return_inverse=True)
+    band = band.ravel()
+    lat_intervals = _sorted_intervals(bounds[:, 0], bounds[:, 1], np.arange(len(bounds)))
+    if lat_intervals[3] > _MAX_OVERLAP_DEPTH:
+        return None
     
-    min_lats = mascons.lat_centers - mascons.lat_spans/2
-    max_lats = mascons.lat_centers + mascons.lat_spans/2
-    min_lons = mascons.lon_centers - mascons.lon_spans/2
-    max_lons = mascons.lon_centers + mascons.lon_spans/2
+    order = np.argsort(band, kind='stable')
+    lon_intervals = []
+    for J_ in np.split(keep[order], np.cumsum(np.bincount(band, minlength=len(bounds)))[:-1]):
+        lon_intervals.append(_sorted_intervals(min_lons[J_], max_lons[J_], J_))
+        if lon_intervals[-1][3] > _MAX_OVERLAP_DEPTH:
+            return None
     
-    mscn_mean = np.nan * np.ones(mascons.N_mascons)
-    for i in range(mascons.N_mascons):
-        
-        if np.min(lats) > max_lats[i]:
+    return lat_intervals, lon_intervals
+
+def _points_in_mascons(bands, lats, lons):
+    # (point, mascon) pairs for every mascon box each point falls in, found with binary searches
+    # on the band latitudes and then on the longitudes within each band
+    lat_intervals, lon_intervals = bands
+    point, band = _intervals_containing(lat_intervals, lats)
+    
+    # Visit the points band by band
+    order = np.argsort(band, kind='stable')
+    point = point[order]
+    counts = np.bincount(band, minlength=len(lon_intervals))
+    points = []
+    mascons = []
+    for k, J_ in enumerate(np.split(point, np.cumsum(counts)[:-1])):
+        if len(J_) == 0:
             continue
-        if np.max(lats) < min_lats[i]:
+        I_, mascon = _intervals_containing(lon_intervals[k], lons[J_])
+        points.append(J_[I_])
+        mascons.append(mascon)
+    
+    if len(points) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(points), np.concatenate(mascons)
+
+def _points_to_mascons_loop(min_lats, max_lats, min_lons, max_lons, lats, lons, values, mscn_mean):
+    # Box test of the points for every mascon, for layouts whose mascons may overlap
+    # (values are NaN-free and the points sorted by latitude, so only the points within
+    # each mascon's latitude range are tested)
+    if len(lats) == 0:
+        return
+    lon_lo, lon_hi = np.min(lons), np.max(lons)
+    lo = np.searchsorted(lats, min_lats)
+    hi = np.searchsorted(lats, max_lats)
+    
+    # Mask buffers reused by every mascon
+    I_buffer = np.empty(len(lats), dtype=bool)
+    J_buffer = np.empty(len(lats), dtype=bool)
+    
+    for i in range(len(mscn_mean)):
+        
+        if lo[i] >= hi[i]:
             continue
-        if np.min(lons) > max_lons[i]:
+        if lon_lo > max_lons[i]:
             continue
-        if np.max(lons) < min_lons[i]:
+        if lon_hi < min_lons[i]:
             continue
         
-        I_ = (lats >= min_lats[i]) & (lats < max_lats[i]) & (lons >= min_lons[i]) & (lons < max_lons[i])
-        m = values[I_]
-        m_lats = lats[I_]
-        
-        m_lats = m_lats[~np.isnan(m)]
-        m = m[~np.isnan(m)]
+        m_lons = lons[lo[i]:hi[i]]
+        I_ = np.greater_equal(m_lons, min_lons[i], out=I_buffer[:len(m_lons)])
+        I_ &= np.less(m_lons, max_lons[i], out=J_buffer[:len(m_lons)])
+        m = values[lo[i]:hi[i]][I_]
         
         if len(m) == 0:
             continue
-        if np.sum(~np.isnan(m)) == 0:
-            continue
 
-        cos_weight = np.cos(m_lats*d2r)
-        mscn_mean[i] = np.nanmean(m) # * cos_weight) / (np.sum(cos_weight) * len(m))
+        mscn_mean[i] = m.mean() # unweighted mean (a cos(lat) weighting is not applied)
+
+if njit is not None:
+    # One pass over the points of each mascon's latitude range, without boolean mask temporaries
+    # (only reassociation is allowed in fastmath, so the sums vectorize while NaN coordinates still fail the box test)
+    @njit(parallel=True, cache=True, fastmath={'reassoc'})
+    def _points_to_mascons_loop(min_lats, max_lats, min_lons, max_lons, lats, lons, values, mscn_mean):
+        if len(lats) == 0:
+            return
+        lon_lo, lon_hi = np.min(lons), np.max(lons)
+        lo = np.searchsorted(lats, min_lats)
+        hi = np.searchsorted(lats, max_lats)
+        
+        for i in prange(len(mscn_mean)):
+            min_lon, max_lon = min_lons[i], max_lons[i]
+            if lo[i] >= hi[i] or lon_lo > max_lon or lon_hi < min_lon:
+                continue
+            
+            # (the box tests are combined without branches)
+            s = 0.0
+            n = 0
+            for k in range(lo[i], hi[i]):
+                inside = (lons[k] >= min_lon) & (lons[k] < max_lon)
+                s += values[k] if inside else 0.0
+                n += inside
+            if n > 0:
+                mscn_mean[i] = s / n
+
+# Marks a mascon object without a stored band lookup
+_NO_BANDS = object()
+
+def points_to_mascons(mascons, lats, lons, values):
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    values = np.asarray(values)
+    
+    min_lats = mascons.min_lats
+    max_lats = mascons.max_lats
+    min_lons = mascons.min_lons
+    max_lons = mascons.max_lons
+    
+    mscn_mean = np.full(mascons.N_mascons, np.nan)
+    
+    # Drop the points with NaN values once, rather than for every mascon
+    I_ = ~np.isnan(values)
+    if not np.all(I_):
+        lats, lons, values = lats[I_], lons[I_], values[I_]
+    
+    # (GSFCmascons pickled before the lookup was stored, or built without __init__, have no _bands;
+    # None is a valid lookup meaning "use the loop", so a separate sentinel marks it as missing)
+    bands = getattr(mascons, '_bands', _NO_BANDS) if isinstance(mascons, GSFCmascons) else _NO_BANDS
+    if bands is _NO_BANDS:
+        bands = _mascon_bands(min_lats, max_lats, min_lons, max_lons)
+    if bands is None:
+        # Sort the points by latitude once, so each mascon only visits its latitude range
+        order = np.argsort(lats, kind='stable')
+        lats, lons, values = lats[order], lons[order], values[order]
+        _points_to_mascons_loop(min_lats, max_lats, min_lons, max_lons, lats, lons, values, mscn_mean)
+        return mscn_mean
+    
+    # Find the mascon(s) of every point in one pass, then average the values of each mascon
+    point, mascon = _points_in_mascons(bands, lats, lons)
+    sums = np.bincount(mascon, weights=values[point], minlength=mascons.N_mascons)
+    counts = np.bincount(mascon, minlength=mascons.N_mascons)
+    
+    J_ = counts > 0
+    mscn_mean[J_] = sums[J_] / counts[J_] # unweighted mean (a cos(lat) weighting is not applied)
     
     return mscn_mean
 
+def _nearest_time_index(times, t, is_sorted=None):
+    # Index of the time nearest to t (the first one on ties), by binary search when the times are sorted
+    # (is_sorted is checked here when not known, e.g. for duck-typed mascons or ones pickled without the flags)
+    if is_sorted is None:
+        is_sorted = bool(np.all(times[1:] >= times[:-1]))
+    if not is_sorted or len(times) < 2:
+        return np.abs(times - t).argmin()
+    
+    j = np.searchsorted(times, t)
+    if j == len(times) or (j > 0 and t - times[j-1] <= times[j] - t):
+        j -= 1
+    return np.searchsorted(times, times[j])
+
 def calc_mascon_delta_cmwe(mascons, start_date, end_date):
     t_0 = np.datetime64(start_date)
     t_1 = np.datetime64(end_date)
     
-    i_0 = np.abs(mascons.times_start - t_0).argmin()
-    i_1 = np.abs(mascons.times_end - t_1).argmin()
+    i_0 = _nearest_time_index(mascons.times_start, t_0, getattr(mascons, '_times_start_sorted', None))
+    i_1 = _nearest_time_index(mascons.times_end, t_1, getattr(mascons, '_times_end_sorted', None))
     
     return mascons.cmwe[:,i_1] - mascons.cmwe[:,i_0]
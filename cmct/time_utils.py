@@ -2,6 +2,10 @@
 import numpy as np
 import cftime 
 import datetime
+import functools
+
+# Number of days per year for the calendars whose years all have the same length
+_FIXED_DAYS_IN_YEAR = {'365_day': 365, 'noleap': 365, '366_day': 366, 'all_leap': 366, '360_day': 360}
 
 def check_datarange(time_var, start_date_cftime, end_date_cftime):
     calendar_type = time_var.to_index().calendar
@@ -17,17 +21,17 @@ def check_datarange(time_var, start_date_cftime, end_date_cftime):
         raise ValueError(f"Error: The selected dates {{start_date_cftime}} or {{end_date_cftime}} are out of range. Model data time range is from {{min_time}} to {{max_time}}.")
 
 
-def days_in_year(date):
-    if date.calendar == '365_day' or date.calendar == 'noleap':
-        diy = 365
-    elif date.calendar == '366_day' or date.calendar == 'all_leap':
-        diy = 366
-    elif date.calendar == '360_day':
-        diy = 360
+@functools.lru_cache(maxsize=4096)
+def _days_in_leap_calendar_year(year, calendar):
+    if cftime.is_leap_year(year, calendar):
+        return 366
     else:
-        if cftime.is_leap_year(date.year, date.calendar):
-            diy = 366
-        else:
-            diy = 365
+        return 365
+
+
+def days_in_year(date):
+    diy = _FIXED_DAYS_IN_YEAR.get(date.calendar)
+    if diy is None:
+        diy = _days_in_leap_calendar_year(date.year, date.calendar)
 
-    return diy
\ No newline at end of file
+    return diy